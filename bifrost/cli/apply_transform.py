@@ -14,10 +14,10 @@ import h5py
 import numpy as np
 import tensorflow as tf
 import voxelmorph as vxm
-from skimage.exposure import equalize_adapthist
 
-from bifrost.io import guarded_ants_image_read, md5sum, read_affine, read_image
-from bifrost.util import transpose_image, update_image_array
+from bifrost.io import (cached_md5sum, guarded_ants_image_read, read_affine,
+                        read_image)
+from bifrost.util import equalize_image, rescale_image, transpose_image
 
 # hide GPUs
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
@@ -85,13 +85,14 @@ def transform(args):
 
     logger.info("Loading moving image: %s", args.image_path)
     moving_img = guarded_ants_image_read(args.image_path)
-    logger.info("Moving image hash: %s", md5sum(args.image_path))
+    logger.info("Moving image hash: %s", cached_md5sum(args.image_path))
     logger.info("Moving image info: \n %s", repr(moving_img))
 
     with h5py.File(f"{args.alignment_path}/transform.h5", "r") as h5_handle:
 
         fixed_img = ants.from_numpy(
-            np.zeros(h5_handle.attrs["fixed.shape"]),
+            # only the geometry is used, float32 halves the placeholder
+            np.zeros(h5_handle.attrs["fixed.shape"], dtype=np.float32),
             origin=tuple(h5_handle.attrs["fixed.origin"]),
             spacing=tuple(h5_handle.attrs["fixed.spacing"]),
             direction=h5_handle.attrs["fixed.direction"],
@@ -143,11 +144,8 @@ def transform(args):
 
         if args.apply_preprocessing and not args.label_image:
             logger.info("Rescaling images")
-            logger.info(
-                "Moving intensity range: %s - %s", moving_img.min(), moving_img.max()
-            )
-            moving_img -= moving_img.min()
-            moving_img /= moving_img.max()
+            moving_img, moving_range = rescale_image(moving_img, in_place=True)
+            logger.info("Moving intensity range: %s - %s", *moving_range)
 
         # ========================================================================== #
         #                          HISTOGRAM EQUALIZATION                            #
@@ -160,15 +158,14 @@ def transform(args):
                     h5_handle.attrs["args.moving_clip_limit"],
                 )
 
-                moving_clahe = equalize_adapthist(
-                    moving_img.numpy(),
+                moving_img = equalize_image(
+                    moving_img,
                     # get won't throw a key error if args.clahe_kernel_size doesn't exist (it might not)
                     kernel_size=h5_handle.attrs.get("args.clahe_kernel_size"),
                     clip_limit=h5_handle.attrs["args.moving_clip_limit"],
+                    in_place=True,
                 )
 
-                moving_img = update_image_array(moving_img, moving_clahe)
-
         # ========================================================================== #
         #                                  AFFINE                                    #
         # ========================================================================== #
@@ -245,36 +242,51 @@ def transform(args):
             logger.info("Applying synthmorph transform")
 
             with tf.device("/CPU:0"):
-                transform = vxm.networks.Transform(moving_img.shape, nb_feats=1)
+                transform = tf.function(
+                    vxm.networks.Transform(moving_img.shape, nb_feats=1)
+                )
+                # converted once, rather than on every call
+                warp = tf.constant(warp.reshape((1,) + warp.shape))
 
                 # transform label image component-by-component
                 if args.label_image:
-                    warped = np.zeros(moving_img.shape)
+                    # float32 represents integer labels exactly up to 2^24
+                    warped = np.zeros(moving_img.shape, dtype=np.float32)
 
                     for label in np.unique(moving_img.numpy()):
                         mask = moving_img.numpy() == label
 
-                        label_image = np.zeros(moving_img.shape)
+                        label_image = np.zeros(moving_img.shape, dtype=np.float32)
                         label_image[mask] = 1
 
-                        warped_label_image = transform.predict(
-                            [
-                                label_image.reshape((1,) + moving_img.shape + (1,)),
-                                warp.reshape((1,) + warp.shape),
-                            ]
-                        ).squeeze()
+                        warped_label_image = (
+                            transform(
+                                [
+                                    label_image.reshape((1,) + moving_img.shape + (1,)),
+                                    warp,
+                                ]
+                            )
+                            .numpy()
+                            .squeeze()
+                        )
 
                         warped_mask = warped_label_image > 0
                         warped_label_image[warped_mask] = 1
 
                         warped[warped_mask] = label
                 else:
-                    warped = transform.predict(
-                        [
-                            moving_img.numpy().reshape((1,) + moving_img.shape + (1,)),
-                            warp.reshape((1,) + warp.shape),
-                        ]
-                    ).squeeze()
+                    warped = (
+                        transform(
+                            [
+                                moving_img.numpy().reshape(
+                                    (1,) + moving_img.shape + (1,)
+                                ),
+                                warp,
+                            ]
+                        )
+                        .numpy()
+                        .squeeze()
+                    )
 
             if lobe_mask is not None:
                 lobe_mask = (
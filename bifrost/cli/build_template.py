@@ -7,17 +7,17 @@ import logging
 import os
 import shutil
 import sys
-from glob import glob
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 
-import ants
-import numpy as np
-import scipy
-from skimage.exposure import equalize_adapthist
-from skimage.filters import threshold_triangle as triangle
-from sklearn.preprocessing import quantile_transform
+from bifrost.util import (equalize_image, rescale_image, sha256,
+                          update_image_array)
 
-from bifrost.io import guarded_ants_image_read
-from bifrost.util import sha256, update_image_array
+CLAHE_KERNEL_SIZE = 64
+CLAHE_CLIP_LIMIT = 0.03
+# if set and non-empty, preprocessing results are cached here and reused across runs and output directories
+PREPROCESSING_CACHE_ENV = "BIFROST_PREPROCESSING_CACHE"
 
 
 def build_template(args):
@@ -26,26 +26,7 @@ def build_template(args):
     #                      PARSE ARGS, CONFIGURE LOGGER                          #
     # ========================================================================== #
 
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-
-    stdout_handler = logging.StreamHandler(stream=sys.stdout)
-    # don't log errors, those get sent to stderr
-    stdout_handler.addFilter(lambda x: x.levelno < logging.WARNING)
-    logger.addHandler(stdout_handler)
-
-    error_handler = logging.StreamHandler(stream=sys.stderr)
-    error_handler.setLevel(logging.WARNING)
-    logger.addHandler(error_handler)
-
-    # ========================================================================== #
-    #                        CONFIGURE LOGGING VERBOSITY                         #
-    # ========================================================================== #
-
-    if args.verbose:
-        stdout_handler.setLevel(logging.INFO)
-    else:
-        stdout_handler.setLevel(logging.CRITICAL + 1)
+    logger = __configure_logger(args.verbose)
 
     try:
 
@@ -122,15 +103,12 @@ def build_template(args):
             input_paths,
         )
 
-        for input_path in input_paths:
-            name = os.path.basename(input_path).split(".")[0]
-            output_path = f"{args.output}/preprocessed/{sha256(input_path.encode())}_{name}.nii"
+        # inputs are independent, fan them out across a few processes
+        # each worker holds several full volumes at once, so this is capped rather than one per core
+        max_workers = max(1, min(args.preprocessing_workers, len(input_paths)))
 
-            if not os.path.exists(output_path):
-                logger.info("Preprocessing %s", input_path)
-                preprocess(args, input_path, output_path)
-            else:
-                logger.info("Cached result found for %s preprocessing", name)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(partial(__preprocess_one, args), input_paths))
 
         # ========================================================================== #
         #                                  AFFINE                                    #
@@ -196,16 +174,17 @@ def build_template(args):
 
         logger.info("Cleaning up")
 
-        shutil.move(
+        # same filesystem, so this is an atomic rename rather than a copy
+        os.replace(
             f"{args.output}/templates/syn_{args.syn_steps - 1}.nii",
             f"{args.output}/template.nii",
         )
 
         if args.keep_intermediates:
-            # add back symlink for the final result which was moved
-            os.symlink(
+            # add back a hardlink for the final result which was moved
+            os.link(
                 f"{args.output}/template.nii",
-                f"{args.output}/templates/syn_{args.syn_steps}.nii",
+                f"{args.output}/templates/syn_{args.syn_steps - 1}.nii",
             )
         else:
             shutil.rmtree(f"{args.output}/preprocessed")
@@ -222,8 +201,66 @@ def build_template(args):
         shutil.rmtree(f"{args.output}/scratch")
 
 
+def __configure_logger(verbose):
+    """Configures the module logger to emit to stdout and stderr
+
+    Handlers left over from a previous call in the same process are removed first,
+    otherwise repeated programmatic invocations would emit every message several times
+    """
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    stdout_handler = logging.StreamHandler(stream=sys.stdout)
+    # don't log errors, those get sent to stderr
+    stdout_handler.addFilter(lambda x: x.levelno < logging.WARNING)
+    logger.addHandler(stdout_handler)
+
+    error_handler = logging.StreamHandler(stream=sys.stderr)
+    error_handler.setLevel(logging.WARNING)
+    logger.addHandler(error_handler)
+
+    if verbose:
+        stdout_handler.setLevel(logging.INFO)
+    else:
+        stdout_handler.setLevel(logging.CRITICAL + 1)
+
+    return logger
+
+
+def __preprocess_one(args, input_path):
+    """Preprocesses a single input unless a cached result exists. Module level so it can be sent to a worker process"""
+    logger = logging.getLogger(__name__)
+
+    name = os.path.basename(input_path).split(".")[0]
+    output_path = f"{args.output}/preprocessed/{sha256(input_path.encode())}_{name}.nii"
+
+    if not os.path.exists(output_path):
+        logger.info("Preprocessing %s", input_path)
+        preprocess(args, input_path, output_path)
+    else:
+        logger.info("Cached result found for %s preprocessing", name)
+
+
 def preprocess(args, input_path, output_path):
     """Runs all preprocessing"""
+    import ants
+
+    from bifrost.io import guarded_ants_image_read
+
+    cache_path = None
+
+    # an empty value leaves the cache off, same as unset
+    if args.preprocessing is not None and os.environ.get(PREPROCESSING_CACHE_ENV):
+        cache_path = __preprocessing_cache_path(args, input_path)
+
+        if os.path.exists(cache_path):
+            __link_or_copy(cache_path, output_path)
+            return
+
     image = guarded_ants_image_read(input_path)
 
     if args.preprocessing is None:
@@ -234,47 +271,94 @@ def preprocess(args, input_path, output_path):
         image = __legacy_preprocess(image)
 
     if "CLAHE" in args.preprocessing:
-        image -= image.min()
-        image /= image.max()
-
-        image = update_image_array(
-            image, equalize_adapthist(image.numpy(), kernel_size=64, clip_limit=0.03)
+        image, _ = rescale_image(image, in_place=True)
+        image = equalize_image(
+            image,
+            kernel_size=CLAHE_KERNEL_SIZE,
+            clip_limit=CLAHE_CLIP_LIMIT,
+            in_place=True,
         )
 
-    ants.image_write(image, output_path)
+    if cache_path is None:
+        ants.image_write(image, output_path)
+    else:
+        # write under a temporary name so an interrupted write never lands in the cache
+        # unique per writer, the cache is shared by concurrent runs, possibly on different hosts
+        partial_path = f"{cache_path[:-len('.nii')]}.{uuid.uuid4().hex}.partial.nii"
+        ants.image_write(image, partial_path)
+        os.replace(partial_path, cache_path)
+
+        __link_or_copy(cache_path, output_path)
+
+
+def __preprocessing_cache_path(args, input_path):
+    """Path of the cached preprocessing result, keyed on the input file's identity and the preprocessing applied"""
+    cache_dir = os.environ[PREPROCESSING_CACHE_ENV]
+    os.makedirs(cache_dir, exist_ok=True)
+
+    stat = os.stat(input_path)
+    key = sha256(
+        (
+            f"{os.path.realpath(input_path)}:{stat.st_size}:{stat.st_mtime_ns}:"
+            f"{sorted(set(args.preprocessing))}:{CLAHE_KERNEL_SIZE}:{CLAHE_CLIP_LIMIT}"
+        ).encode()
+    )
+
+    return f"{cache_dir}/{key[:16]}.nii"
+
+
+def __link_or_copy(src, dst):
+    """Hardlink src to dst, falling back to a copy across filesystems"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
 
 
 def __legacy_preprocess(image):
     """Legacy preprocessing"""
+    import numpy as np
+    import scipy.ndimage
+    import scipy.stats
+    from skimage.filters import threshold_triangle as triangle
 
     image_arr = image.numpy()
 
     # Blur brain and mask small values
-    image_copy = image_arr.copy().astype("float32")
-    image_copy = scipy.ndimage.gaussian_filter(image_copy, sigma=10)
+    # gaussian_filter already filters axes after the first in place, so blurring into the input is safe
+    # C order, as the fresh gaussian_filter output was, rather than inheriting ANTs' Fortran order
+    image_copy = image_arr.astype("float32", order="C")
+    scipy.ndimage.gaussian_filter(image_copy, sigma=10, output=image_copy)
     threshold = triangle(image_copy)
-    image_copy[np.where(image_copy < threshold / 2)] = 0
+    image_copy[image_copy < threshold / 2] = 0
 
     # Remove blobs outside contiguous brain
-    labels, label_nb = scipy.ndimage.label(image_copy)
-    image_label = np.bincount(labels.flatten())[1:].argmax() + 1
-    image_copy = image_arr.copy().astype("float32")
-    image_copy[np.where(labels != image_label)] = np.nan
-
-    # Perform quantile normalization
-    image_copy = quantile_transform(
-        image_copy.flatten().reshape(-1, 1), n_quantiles=500, random_state=0
-    )
-    image_copy = image_copy.reshape(image_arr.shape)
+    # label straight into an intp array, so the raveled view can be counted without a copy
+    labels = np.empty(image_copy.shape, dtype=np.intp)
+    scipy.ndimage.label(image_copy, output=labels)
+    image_label = np.bincount(labels.ravel())[1:].argmax() + 1
+    # the blurred image is no longer needed, reuse its buffer for the masked original
+    image_copy.fill(np.nan)
+    np.copyto(image_copy, image_arr, casting="unsafe", where=labels == image_label)
 
-    return update_image_array(image, np.nan_to_num(image_copy))
+    # Perform quantile normalization, mapping the masked voxels' ranks onto [0, 1]
+    # index with a 3D mask, ravel copies rather than aliases the Fortran ordered arrays ANTs returns
+    valid = ~np.isnan(image_copy)
+    ranks = scipy.stats.rankdata(image_copy[valid], method="average")
+    image_copy[valid] = (ranks - 1) / max(len(ranks) - 1, 1)
+    image_copy[~valid] = 0
 
+    return update_image_array(image, image_copy, in_place=True)
 
-def generate_template(args, step_name, output_path, transform_avg):
+
+def generate_template(args, step_name, output_path, transform_avg, file_list):
     """Generates template from registration results
 
     Depending on the experiment type this either averages the images directly or 'averages' their transformations
+    file_list holds the registered images of the step, transforms are found alongside them
     """
+    import ants
+
     logger = logging.getLogger(__name__)
     __retries = 0
 
@@ -282,8 +366,6 @@ def generate_template(args, step_name, output_path, transform_avg):
 
     while True:
         try:
-            input_path = f"{args.output}/scratch/{step_name}"
-
             # 'average' transformations
             #
             # NOTE: a shortcoming of this method is that the affine transform is assumed to be nearly the identity
@@ -297,13 +379,14 @@ def generate_template(args, step_name, output_path, transform_avg):
                 transform_dir = f"{args.output}/scratch/{step_name}_transform"
 
                 if os.path.exists(f"{transform_dir}/transform.nii"):
-                    logger.info("%s: found existing inverse average transform")
-                    avg_img = __average_images(f"{input_path}/*.nii")
+                    logger.info(
+                        "%s: found existing inverse average transform", step_name
+                    )
+                    avg_img = __average_images(file_list)
                 else:
                     os.makedirs(transform_dir, exist_ok=True)
 
-                    avg_img = __average_images(f"{input_path}/*.nii")
-                    avg_transform = __average_images(f"{input_path}/*.nii.gz")
+                    avg_img, avg_transform = __average_images_and_transforms(file_list)
 
                     # this could only ever be construed as an inverse if you squint, a lot
                     inv_avg_transform = avg_transform * -1 * args.gradient_step
@@ -320,7 +403,7 @@ def generate_template(args, step_name, output_path, transform_avg):
 
             # average images directly
             else:
-                template = __average_images(f"{input_path}/*.nii")
+                template = __average_images(file_list)
                 ants.image_write(template, output_path)
 
             break
@@ -332,8 +415,12 @@ def generate_template(args, step_name, output_path, transform_avg):
                 __retries += 1
             else:
                 logger.exception("Caught exception, max retries reached")
+                __cached_average_images.cache_clear()
                 raise exc
 
+    # averages are only reused by retries of this step, don't hold them for the rest of the run
+    __cached_average_images.cache_clear()
+
 
 def alignment_iteration(
     args,
@@ -345,7 +432,6 @@ def alignment_iteration(
     mirror,
 ):
     logger = logging.getLogger(__name__)
-    __retries = 0
 
     step_dir = f"{args.output}/scratch/{step_name}"
     os.makedirs(step_dir, exist_ok=True)
@@ -354,101 +440,237 @@ def alignment_iteration(
         logger.info(f"{step_name} template already exists")
         return
 
-    fixed = ants.image_read(fixed_path)
+    # each registration is multi-threaded by ITK, so only run as many as there are free cores for
+    max_workers = max(1, os.cpu_count() // __ants_thread_count())
+
+    align = partial(
+        __align_one,
+        step_name=step_name,
+        step_dir=step_dir,
+        fixed_path=fixed_path,
+        type_of_transform=type_of_transform,
+        transform_avg=transform_avg,
+        mirror=mirror,
+    )
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        registered_paths = [
+            registered_path
+            for input_paths in executor.map(align, __list_niftis(moving_dir))
+            for registered_path in input_paths
+        ]
+
+    logger.info("Generating new template for  %s", step_name)
+    generate_template(
+        args,
+        step_name=step_name,
+        output_path=f"{args.output}/templates/{step_name}.nii",
+        transform_avg=transform_avg,
+        file_list=registered_paths,
+    )
+
+    logger.info("Finished %s", step_name)
+
 
-    for input_path in glob(f"{moving_dir}/*.nii"):
-        input_name = None
+def __align_one(
+    input_path,
+    step_name,
+    step_dir,
+    fixed_path,
+    type_of_transform,
+    transform_avg,
+    mirror,
+):
+    """Registers a single input to fixed. Module level so it can be sent to a worker process
+
+    Returns:
+      output_paths: registered image paths, including the mirror if requested - list
+    """
+    import ants
+    import numpy as np
 
-        while True:
-            try:
-                input_name = input_path.split("/")[-1].split(".")[0]
+    logger = logging.getLogger(__name__)
+    __retries = 0
 
-                if __step_output_exists(input_name, step_dir, transform_avg, False):
+    # the same worker process sees the same fixed image for every input it handles
+    fixed = __image_read(fixed_path)
+    input_name = None
+
+    while True:
+        try:
+            input_name = input_path.split("/")[-1].split(".")[0]
+            moving = None
+
+            if __step_output_exists(input_name, step_dir, transform_avg, False):
+                logger.info("%s: found cached result for %s ", step_name, input_name)
+            else:
+                logger.info("%s: processing %s", step_name, input_name)
+
+                moving = __image_read(input_path)
+
+                registration = ants.registration(
+                    fixed, moving, type_of_transform=type_of_transform
+                )
+
+                __write_step_output(
+                    registration,
+                    input_name,
+                    step_dir,
+                    write_transform=transform_avg,
+                    mirror=False,
+                )
+
+            if mirror:
+                if __step_output_exists(input_name, step_dir, transform_avg, True):
                     logger.info(
-                        "%s: found cached result for %s ", step_name, input_name
+                        "%s: found existing work for input %s mirror",
+                        step_name,
+                        input_name,
                     )
                 else:
-                    logger.info("%s: processing %s", step_name, input_name)
+                    logger.info("%s: processing input %s mirror", step_name, input_name)
 
-                    moving = ants.image_read(input_path)
+                    if moving is None:
+                        moving = __image_read(input_path)
 
-                    registration = ants.registration(
-                        fixed, moving, type_of_transform=type_of_transform
+                    moving_mirror = update_image_array(
+                        moving, np.flip(moving.numpy(), axis=0)
+                    )
+
+                    registration_mirror = ants.registration(
+                        fixed, moving_mirror, type_of_transform=type_of_transform
                     )
 
                     __write_step_output(
-                        registration,
+                        registration_mirror,
                         input_name,
                         step_dir,
                         write_transform=transform_avg,
-                        mirror=False,
+                        mirror=True,
                     )
+            break
+        except Exception as exc:
+            if __retries < 2:
+                logger.exception(
+                    "Caught exception processing input %s, retrying", input_name
+                )
 
-                if mirror:
-                    if __step_output_exists(input_name, step_dir, transform_avg, True):
-                        logger.info(
-                            "%s: found existing work for input %s mirror",
-                            step_name,
-                            input_name,
-                        )
-                    else:
-                        logger.info(
-                            "%s: processing input %s mirror", step_name, input_name
-                        )
-
-                        moving_mirror = update_image_array(moving, moving[::-1])
-
-                        registration_mirror = ants.registration(
-                            fixed, moving_mirror, type_of_transform=type_of_transform
-                        )
-
-                        __write_step_output(
-                            registration_mirror,
-                            input_name,
-                            step_dir,
-                            write_transform=transform_avg,
-                            mirror=True,
-                        )
-                break
-            except Exception as exc:
-                if __retries < 2:
-                    logger.exception(
-                        "Caught exception processing input %s, retrying", input_name
-                    )
+                __clean_step_output(input_name, step_dir, mirror)
+                __retries += 1
+            else:
+                logger.exception(
+                    "Caught exception processing input %s, max retries reached",
+                    input_name,
+                )
+                raise exc
 
-                    __clean_step_output(input_name, step_dir, mirror)
-                    __retries += 1
-                else:
-                    logger.exception(
-                        "Caught exception processing input %s, max retries reached",
-                        input_name,
-                    )
-                    raise exc
+    output_paths = [f"{step_dir}/{input_name}.nii"]
 
-    logger.info("Generating new template for  %s", step_name)
-    generate_template(
-        args,
-        step_name=step_name,
-        output_path=f"{args.output}/templates/{step_name}.nii",
-        transform_avg=transform_avg,
+    if mirror:
+        output_paths.append(f"{step_dir}/{input_name}_m.nii")
+
+    return output_paths
+
+
+def __list_niftis(directory):
+    """Sorted paths of the NIfTIs in directory, listed in a single scandir pass"""
+    with os.scandir(directory) as entries:
+        return sorted(entry.path for entry in entries if entry.name.endswith(".nii"))
+
+
+def __image_read(path):
+    """ants.image_read, memoized on path and modification time"""
+    return __cached_image_read(path, os.path.getmtime(path))
+
+
+@lru_cache(maxsize=4)
+def __cached_image_read(path, mtime):
+    import ants
+
+    return ants.image_read(path)
+
+
+def __ants_thread_count():
+    """Number of threads used by each ANTs call. ITK uses every core unless told otherwise"""
+    return int(os.environ.get("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", os.cpu_count()))
+
+
+def __average_images(img_paths):
+    (avg_img,) = __cached_average_images(__path_mtimes(img_paths))
+
+    return avg_img
+
+
+def __average_images_and_transforms(img_paths):
+    """Averages the images and their '_t.nii.gz' transforms in a single pass"""
+    path_mtimes = __path_mtimes(
+        img_paths, lambda img_path: f"{img_path[:-len('.nii')]}_t.nii.gz"
     )
 
-    logger.info("Finished %s", step_name)
+    return __cached_average_images(path_mtimes)
+
 
+def __path_mtimes(img_paths, *related_paths):
+    """Sorted tuple of ((path, mtime), ...) rows: each image path, then related_paths applied to it.
+    Keying on modification times means a rewritten input invalidates any cached average
+    """
+    return tuple(
+        tuple(
+            (path, os.path.getmtime(path))
+            for path in [img_path] + [related(img_path) for related in related_paths]
+        )
+        for img_path in sorted(img_paths)
+    )
+
+
+@lru_cache(maxsize=2)
+def __cached_average_images(path_mtimes):
+    """Averages each column of path_mtimes, reading the files of a row together
+    Memoized so retries in generate_template don't re-read the step, which clears the cache once done
+    """
+    import ants
+    import numpy as np
+
+    first_images = [ants.image_read(path) for path, _ in path_mtimes[0]]
+
+    # accumulate raw sums and divide once at the end, avoids a temporary per image
+    sums = [image.numpy().astype(np.float64) for image in first_images]
+
+    def read_row(row):
+        return [ants.image_read(path).numpy() for path, _ in row]
+
+    def accumulate(arrays):
+        for img_sum, array in zip(sums, arrays):
+            img_sum += array
 
-def __average_images(pattern):
-    img_paths = glob(pattern)
+    # read the next row in the background while the current one is summed
+    # at most one row is in flight, so memory use stays bounded
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
 
-    img_0 = ants.image_read(img_paths[0])
-    avg_img = img_0.numpy() / len(img_paths)
+        for row in path_mtimes[1:]:
+            upcoming = executor.submit(read_row, row)
 
-    for img_path in img_paths[1:]:
-        avg_img += ants.image_read(img_path).numpy() / len(img_paths)
+            if pending is not None:
+                accumulate(pending.result())
 
-    return update_image_array(img_0, avg_img)
+            pending = upcoming
+
+        if pending is not None:
+            accumulate(pending.result())
+
+    for img_sum in sums:
+        img_sum *= 1.0 / len(path_mtimes)
+
+    return tuple(
+        update_image_array(image, img_sum.astype(np.float32), in_place=True)
+        for image, img_sum in zip(first_images, sums)
+    )
 
 
 def __write_step_output(registration, input_name, step_dir, write_transform, mirror):
+    import ants
+
     suffix = ""
     if mirror:
         suffix = "_m"
@@ -464,13 +686,16 @@ def __write_step_output(registration, input_name, step_dir, write_transform, mir
             f"{step_dir}/{input_name}{suffix}_t.nii.gz",
         )
 
+    # written last, so a partial result left behind by a killed job is never mistaken for a finished one
+    open(f"{step_dir}/{input_name}{suffix}.done", "w").close()
+
 
 def __step_output_exists(input_name, step_dir, write_transform, mirror):
     suffix = ""
     if mirror:
         suffix = "_m"
 
-    if not os.path.exists(f"{step_dir}/{input_name}{suffix}.nii"):
+    if not os.path.exists(f"{step_dir}/{input_name}{suffix}.done"):
         return False
 
     if write_transform and not os.path.exists(
@@ -486,6 +711,11 @@ def __clean_step_output(input_name, step_dir, mirror):
     if mirror:
         suffix = "_m"
 
+    try:
+        os.remove(f"{step_dir}/{input_name}{suffix}.done")
+    except FileNotFoundError:
+        pass
+
     try:
         os.remove(f"{step_dir}/{input_name}{suffix}.nii")
     except FileNotFoundError:
@@ -3,6 +3,7 @@
 Execute using the 'bifrost' executable installed by setuptools
 """
 
+import gc
 import logging
 import os
 import shutil
@@ -14,16 +15,19 @@ import h5py
 import numpy as np
 import tensorflow as tf
 import voxelmorph as vxm
-from skimage.exposure import equalize_adapthist
+from scipy.ndimage import zoom
 
-from bifrost.io import (download_weights, guarded_ants_image_read, md5sum,
-                        write_affine, write_image)
-from bifrost.util import package_path, transpose_image, update_image_array
+from bifrost.io import (cached_md5sum, compression_kwargs, download_weights,
+                        guarded_ants_image_read, write_affine, write_image)
+from bifrost.util import (equalize_image, package_path, rescale_image,
+                          transpose_image)
 
 # hide GPUs
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
 # suppress tensorflow import warnings
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+# run affine and SyN on every core, unless the caller pinned a thread count
+os.environ.setdefault("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", str(os.cpu_count()))
 
 
 TARGET_SHAPE = (160, 160, 192)
@@ -129,15 +133,34 @@ def register(args):
 
         logger.info("Loading moving image: %s", args.moving)
         moving_img = guarded_ants_image_read(args.moving)
-        moving_md5sum = md5sum(args.moving)
+        moving_md5sum = cached_md5sum(args.moving)
         logger.info("Moving image hash: %s", moving_md5sum)
         logger.info("Moving image info: \n %s", repr(moving_img))
 
         h5_handle.attrs["moving.md5sum"] = moving_md5sum
 
+        # the SynthMorph mask is checked against the moving image as it was read
+        moving_shape = moving_img.shape
+        moving_spacing = moving_img.spacing
+        moving_direction = moving_img.direction
+
+        # resample each image as soon as it's read, so at most one full resolution volume is resident
+        if args.downsample_to > 0:
+            desired_spacing = (args.downsample_to,) * 3
+
+            if moving_img.spacing != desired_spacing:
+                logger.info(
+                    "Resampling moving image. Current resolution: %s, Desired resolution: %s",
+                    moving_img.spacing,
+                    desired_spacing,
+                )
+                moving_img = ants.resample_image(
+                    moving_img, desired_spacing, interp_type=3
+                )
+
         logger.info("Loading fixed image: %s", args.fixed)
         fixed_img = guarded_ants_image_read(args.fixed)
-        fixed_md5sum = md5sum(args.fixed)
+        fixed_md5sum = cached_md5sum(args.fixed)
         logger.info("Fixed image hash: %s", fixed_md5sum)
         logger.info("Fixed image info: \n %s", repr(fixed_img))
 
@@ -150,18 +173,31 @@ def register(args):
         h5_handle.attrs["fixed.direction"] = fixed_img.direction
         h5_handle.attrs["fixed.has_components"] = fixed_img.has_components
 
+        if args.downsample_to > 0:
+            desired_spacing = (args.downsample_to,) * 3
+
+            if fixed_img.spacing != desired_spacing:
+                logger.info(
+                    "Resampling fixed image. Current resolution: %s, Desired resolution: %s",
+                    fixed_img.spacing,
+                    desired_spacing,
+                )
+                fixed_img = ants.resample_image(
+                    fixed_img, desired_spacing, interp_type=3
+                )
+
         synthmorph_mask = None
 
         if args.synthmorph_mask is not None:
             logger.info("Loading SynthMorph mask: %s", args.synthmorph_mask)
             synthmorph_mask = guarded_ants_image_read(args.synthmorph_mask)
-            logger.info("SynthMorph mask hash: %s", md5sum(args.synthmorph_mask))
+            logger.info("SynthMorph mask hash: %s", cached_md5sum(args.synthmorph_mask))
 
             if (
                 not (
-                    synthmorph_mask.shape == moving_img.shape
-                    and synthmorph_mask.spacing == moving_img.spacing
-                    and (synthmorph_mask.direction == moving_img.direction).all()
+                    synthmorph_mask.shape == moving_shape
+                    and synthmorph_mask.spacing == moving_spacing
+                    and (synthmorph_mask.direction == moving_direction).all()
                 )
                 and args.downsample_to > 0
             ):
@@ -195,43 +231,16 @@ def register(args):
 
             write_image(h5_handle, "/synthmorph_mask", synthmorph_mask)
 
-        if args.downsample_to > 0:
-            desired_spacing = (args.downsample_to,) * 3
-
-            if moving_img.spacing != desired_spacing:
-                logger.info(
-                    "Resampling moving image. Current resolution: %s, Desired resolution: %s",
-                    moving_img.spacing,
-                    desired_spacing,
-                )
-                moving_img = ants.resample_image(
-                    moving_img, desired_spacing, interp_type=3
-                )
-
-            if fixed_img.spacing != desired_spacing:
-                logger.info(
-                    "Resampling fixed image. Current resolution: %s, Desired resolution: %s",
-                    fixed_img.spacing,
-                    desired_spacing,
-                )
-                fixed_img = ants.resample_image(
-                    fixed_img, desired_spacing, interp_type=3
-                )
-
         # ========================================================================== #
         #                                  RESCALE                                   #
         # ========================================================================== #
 
         logger.info("Rescaling images")
-        logger.info(
-            "Moving intensity range: %s - %s", moving_img.min(), moving_img.max()
-        )
-        moving_img -= moving_img.min()
-        moving_img /= moving_img.max()
+        moving_img, moving_range = rescale_image(moving_img, in_place=True)
+        logger.info("Moving intensity range: %s - %s", *moving_range)
 
-        logger.info("Fixed intensity range: %s - %s", fixed_img.min(), fixed_img.max())
-        fixed_img -= fixed_img.min()
-        fixed_img /= fixed_img.max()
+        fixed_img, fixed_range = rescale_image(fixed_img, in_place=True)
+        logger.info("Fixed intensity range: %s - %s", *fixed_range)
 
         # ========================================================================== #
         #                          HISTOGRAM EQUALIZATION                            #
@@ -240,25 +249,23 @@ def register(args):
         if args.moving_clip_limit > 0:
             logger.info("Running moving CLAHE. Clip limit: %s", args.moving_clip_limit)
 
-            moving_clahe = equalize_adapthist(
-                moving_img.numpy(),
+            moving_img = equalize_image(
+                moving_img,
                 kernel_size=args.clahe_kernel_size,
                 clip_limit=args.moving_clip_limit,
+                in_place=True,
             )
 
-            moving_img = update_image_array(moving_img, moving_clahe)
-
         if args.fixed_clip_limit > 0:
             logger.info("Running fixed CLAHE. Clip limit: %s", args.fixed_clip_limit)
 
-            fixed_clahe = equalize_adapthist(
-                fixed_img.numpy(),
+            fixed_img = equalize_image(
+                fixed_img,
                 kernel_size=args.clahe_kernel_size,
                 clip_limit=args.fixed_clip_limit,
+                in_place=True,
             )
 
-            fixed_img = update_image_array(fixed_img, fixed_clahe)
-
         logger.debug("Histogram equalization complete")
 
         # ========================================================================== #
@@ -299,6 +306,9 @@ def register(args):
                     f"{results_dir}/registered.nii", f"{results_dir}/affine.nii"
                 )
 
+            # drop warpedfixout, a full volume that's never used
+            del affine
+
         # ========================================================================== #
         #                           CALCULATE TRANSPOSITION                          #
         # ========================================================================== #
@@ -318,11 +328,28 @@ def register(args):
         if args.mirror_warp:
             axis_rms = []
 
+            affine_img = moving_img.numpy()
+
+            # |A - flip(A)|^2 = 2|A|^2 - 2<A, flip(A)>, each term is a single pass without temporaries
+            # accumulate in float64, the difference of two large sums loses precision in float32
+            sum_sq = np.einsum("ijk,ijk->", affine_img, affine_img, dtype=np.float64)
+
             for axis_idx in range(3):
-                affine_img = moving_img.numpy()
-                mirrored_img = np.flip(affine_img, axis_idx)
+                # <A, flip(A)> pairs slice i with slice n - 1 - i, so each pair is counted twice
+                # summing over the first half only reads each voxel once, plus the middle slice if n is odd
+                slices = np.moveaxis(affine_img, axis_idx, 0)
+                half = slices.shape[0] // 2
 
-                axis_rms.append(np.sqrt(np.sum((affine_img - mirrored_img) ** 2)))
+                cross = 2 * np.einsum(
+                    "ijk,ijk->", slices[:half], slices[::-1][:half], dtype=np.float64
+                )
+
+                if slices.shape[0] % 2:
+                    cross += np.einsum(
+                        "jk,jk->", slices[half], slices[half], dtype=np.float64
+                    )
+
+                axis_rms.append(np.sqrt(max(2 * sum_sq - 2 * cross, 0)))
 
                 logger.debug("Axis %s mirrored RMS: %s", axis_idx, axis_rms[-1])
 
@@ -365,6 +392,8 @@ def register(args):
             if args.keep_intermediates:
                 shutil.copy(f"{results_dir}/registered.nii", f"{results_dir}/syn.nii")
 
+            del syn
+
         # ========================================================================== #
         #                                SYNTHMORPH                                  #
         # ========================================================================== #
@@ -409,9 +438,6 @@ def register(args):
             fixed = fixed_img.numpy().reshape((1,) + fixed_img.shape + (1,))
             logger.debug("Fixed volfile shape: %s", fixed.shape)
 
-            inshape = moving.shape[1:-1]
-            nb_feats = moving.shape[-1]
-
             with tf.device(DEVICE):
                 # load model
                 model = vxm.networks.VxmDense.load(MODEL_WEIGHTS_PATH)
@@ -419,22 +445,31 @@ def register(args):
                 logger.info("Running inference")
 
                 # run inference
-                warp = model.register(moving, fixed)
+                # called as a traced function, Model.predict wraps one sample in its batching machinery
+                register_fn = tf.function(model.get_registration_model())
+                # the network runs in float32, keep the warp there so nothing downstream promotes to float64
+                warp = (
+                    register_fn([moving, fixed]).numpy().astype(np.float32, copy=False)
+                )
 
                 # symmetrize warp
                 if args.mirror_warp:
+                    # average with the mirrored warp, whose mirror axis component changes sign
+                    # one output buffer, the flip is a view
                     flipped_warp = np.flip(warp, mirror_axis + 1)
-                    mirrored_warp = np.mean([warp, flipped_warp], axis=0)
-                    mirrored_warp[:, :, :, :, mirror_axis] = np.mean(
-                        [warp, -flipped_warp], axis=0
-                    )[:, :, :, :, mirror_axis]
+                    mirrored_warp = np.add(warp, flipped_warp)
+                    np.subtract(
+                        warp[..., mirror_axis],
+                        flipped_warp[..., mirror_axis],
+                        out=mirrored_warp[..., mirror_axis],
+                    )
+                    mirrored_warp *= 0.5
                     warp = mirrored_warp
 
-                moved = vxm.networks.Transform(inshape, nb_feats=nb_feats).predict(
-                    [moving, warp]
-                )
-
-                moving = moved
+                # keras models hold reference cycles, collect the network before allocating full-res arrays
+                # the traced function references every layer too, so both must go
+                del model, register_fn
+                gc.collect()
 
             # ========================================================================== #
             #                       UPSAMPLE WARP AND APPLY                              #
@@ -445,50 +480,52 @@ def register(args):
             warp = warp.squeeze()
 
             full_res_moving = transpose_image(full_res_moving, optimal_transposition)
+            # copied out of ITK once, used for both the warp and the masked fill below
+            full_res_arr = full_res_moving.numpy()
 
-            upsampled_warp = np.zeros(full_res_moving.shape + (3,))
+            # synthmorph predicts float32 displacements, storing them as float64 only doubles the bytes
+            # every voxel is written by zoom, so the buffer needn't be zeroed
+            upsampled_warp = np.empty(full_res_moving.shape + (3,), dtype=np.float32)
             logger.debug("Upsampled warp shape: %s", upsampled_warp.shape)
 
-            for idx in range(3):
-                rescale_factor = full_res_moving.shape[idx] / TARGET_SHAPE[idx]
-                upsampled_warp[:, :, :, idx] = (
-                    ants.resample_image(
-                        ants.from_numpy(warp[:, :, :, idx]),
-                        full_res_moving.shape,
-                        True,
-                        0,
-                    ).numpy()
-                    * rescale_factor
-                )
+            # linear interpolation of all three channels in one pass, corner aligned like ants.resample_image
+            # displacements are in voxels, so each channel is also scaled by the change in resolution
+            rescale_factors = np.divide(full_res_moving.shape, TARGET_SHAPE)
+            zoom(warp, tuple(rescale_factors) + (1,), output=upsampled_warp, order=1)
+            upsampled_warp *= rescale_factors.astype(np.float32)
+
+            assert upsampled_warp.dtype == np.float32
 
             h5_handle.create_dataset(
                 "/synthmorph",
                 data=upsampled_warp,
-                chunks=True,
-                compression="gzip",
-                compression_opts=9,
-                shuffle=True,
-                fletcher32=True,
+                **compression_kwargs(upsampled_warp.shape),
             )
 
             logger.info("Applying upsampled warp")
 
             with tf.device(DEVICE):
-                transform = vxm.networks.Transform(full_res_moving.shape, nb_feats=1)
-                warped = transform.predict(
-                    [
-                        full_res_moving.numpy().reshape(
-                            (1,) + full_res_moving.shape + (1,)
-                        ),
-                        upsampled_warp.reshape((1,) + upsampled_warp.shape),
-                    ]
-                ).squeeze()
+                transform = tf.function(
+                    vxm.networks.Transform(full_res_moving.shape, nb_feats=1)
+                )
+                warped = (
+                    transform(
+                        [
+                            full_res_arr.reshape((1,) + full_res_arr.shape + (1,)),
+                            upsampled_warp.reshape((1,) + upsampled_warp.shape),
+                        ]
+                    )
+                    .numpy()
+                    .squeeze()
+                )
 
             if args.synthmorph_mask is not None:
                 synthmorph_mask = (
                     transpose_image(synthmorph_mask, optimal_transposition).numpy() > 0
                 )
-                warped[synthmorph_mask] = full_res_moving[synthmorph_mask]
+                warped[synthmorph_mask] = full_res_arr[synthmorph_mask]
+
+            del full_res_arr, upsampled_warp
 
             warped = transpose_image(ants.from_numpy(warped), inverse_transposition)
             warped.set_spacing(full_res_moving.spacing)
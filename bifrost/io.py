@@ -2,17 +2,41 @@
 Module for I/O related methods
 """
 
+import contextlib
 import hashlib
+import json
 import logging
 import os
 import urllib
 
 import ants
 import h5py
+import hdf5plugin
 import numpy as np
 
 from bifrost.util import package_path
 
+# 64^3 float32 chunks are 1 MiB
+H5_CHUNK_EDGE = 64
+
+# set to checksum each HDF5 chunk with fletcher32, off by default since the CRC is computed serially on every write
+H5_CHECKSUM_ENV = "BIFROST_H5_CHECKSUM"
+# values of H5_CHECKSUM_ENV that leave checksums off, compared case-insensitively
+H5_CHECKSUM_OFF = ("", "0", "false", "no", "off")
+
+# md5sum read size on Python < 3.11, large reads amortize the per-call overhead
+MD5_CHUNK_SIZE = 1 << 20
+
+# maps absolute path to size, modification time and md5sum, so unchanged inputs aren't re-read
+HASH_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "bifrost",
+    "hashes.json",
+)
+
+# c-blosc reads this on every compression call, so chunks are split across all cores
+os.environ.setdefault("BLOSC_NTHREADS", str(os.cpu_count()))
+
 
 def write_affine(h5_handle, name, transform):
     """Write ANTs affine transform to h5
@@ -84,13 +108,7 @@ def write_image(h5_handle, name, image):
     image_arr = image.numpy()
 
     h5_handle.create_dataset(
-        name,
-        data=image_arr,
-        chunks=True,
-        compression="gzip",
-        compression_opts=9,
-        shuffle=True,
-        fletcher32=True,
+        name, data=image_arr, **compression_kwargs(image_arr.shape)
     )
 
     h5_handle[name].attrs["origin"] = image.origin
@@ -99,6 +117,33 @@ def write_image(h5_handle, name, image):
     h5_handle[name].attrs["has_components"] = image.has_components
 
 
+def compression_kwargs(shape):
+    """h5py create_dataset kwargs for volumetric data of shape
+
+    Spatial axes are chunked in H5_CHUNK_EDGE cubes, trailing (component) axes are kept whole.
+    Chunks are compressed with LZ4 + byte shuffle via Blosc, much faster than gzip at a similar ratio on floats
+    Reading them back requires hdf5plugin to be imported, which importing this module does
+    Chunks are checksummed with fletcher32 only if the H5_CHECKSUM_ENV environment variable is set
+    to a value other than empty, 0, false, no or off
+
+    Args:
+      shape: dataset shape, spatial axes first - tuple
+
+    Returns:
+      kwargs - dict
+    """
+    chunks = tuple(min(H5_CHUNK_EDGE, dim) for dim in shape[:3]) + tuple(shape[3:])
+    checksum = (
+        os.environ.get(H5_CHECKSUM_ENV, "").strip().lower() not in H5_CHECKSUM_OFF
+    )
+
+    return dict(
+        chunks=chunks,
+        fletcher32=checksum,
+        **hdf5plugin.Blosc(cname="lz4", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE),
+    )
+
+
 def read_image(h5_handle, name, directory=None):
     """Reads ANTs image from h5
     If directory is not None, writes to a file and returns absolute path
@@ -157,18 +202,101 @@ def md5sum(filename):
     Returns:
       file_hash - str
     """
-    file_hash = hashlib.md5()
-
     with open(filename, "rb") as file_handle:
-        chunk = file_handle.read(8192)
+        # file_digest hashes straight from the file descriptor, without the per-chunk Python loop
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(file_handle, "md5").hexdigest()
+
+        file_hash = hashlib.md5()
+        buffer = bytearray(MD5_CHUNK_SIZE)
+        view = memoryview(buffer)
 
-        while chunk:
-            file_hash.update(chunk)
-            chunk = file_handle.read(8192)
+        while True:
+            n_read = file_handle.readinto(buffer)
+
+            if not n_read:
+                break
+
+            file_hash.update(view[:n_read])
 
     return file_hash.hexdigest()
 
 
+def cached_md5sum(filename):
+    """md5sum, memoized across runs on the file's path, size and modification time
+
+    Falls back to hashing the file if the cache can't be read or written
+
+    Args:
+      filename - str
+
+    Returns:
+      file_hash - str
+    """
+    stat = os.stat(filename)
+    key = os.path.realpath(filename)
+    entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    logger = logging.getLogger(__name__)
+
+    try:
+        with __locked_hash_cache() as hashes:
+            cached = hashes.get(key)
+    except OSError:
+        logger.warning("Hash cache %s unreadable", HASH_CACHE_PATH, exc_info=True)
+        return md5sum(filename)
+
+    if (
+        isinstance(cached, dict)
+        and all(cached.get(k) == v for k, v in entry.items())
+        and isinstance(cached.get("md5sum"), str)
+    ):
+        return cached["md5sum"]
+
+    file_hash = md5sum(filename)
+
+    try:
+        with __locked_hash_cache(write=True) as hashes:
+            hashes[key] = dict(entry, md5sum=file_hash)
+    except OSError:
+        logger.warning("Hash cache %s unwritable", HASH_CACHE_PATH, exc_info=True)
+
+    return file_hash
+
+
+@contextlib.contextmanager
+def __locked_hash_cache(write=False):
+    """Yields the hash cache dict under an exclusive lock, written back on exit if write is set"""
+    import fcntl
+
+    os.makedirs(os.path.dirname(HASH_CACHE_PATH), exist_ok=True)
+
+    with open(f"{HASH_CACHE_PATH}.lock", "w") as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+
+        try:
+            with open(HASH_CACHE_PATH, "r") as cache_handle:
+                hashes = json.load(cache_handle)
+        # ValueError covers both invalid JSON and bytes that aren't UTF-8
+        except (FileNotFoundError, ValueError):
+            hashes = {}
+
+        # a corrupt cache is discarded, and rewritten on the next write
+        if not isinstance(hashes, dict):
+            hashes = {}
+
+        yield hashes
+
+        if write:
+            # write then rename, a crash mid-write leaves the previous cache intact
+            tmp_path = f"{HASH_CACHE_PATH}.{os.getpid()}.tmp"
+
+            with open(tmp_path, "w") as cache_handle:
+                json.dump(hashes, cache_handle)
+
+            os.replace(tmp_path, HASH_CACHE_PATH)
+
+
 def download_weights(shapes=True):
     """Download synthmorph weights. By default the 'shapes' weights are downloaded"""
     if shapes:
@@ -13,12 +13,13 @@ import bifrost
 SYNTHMORPH_SHAPE = (160, 160, 192)
 
 
-def update_image_array(image, updated):
+def update_image_array(image, updated, in_place=False):
     """Update ANTs.Image image array but preserve metadata
 
     Args:
       image - ants.ANTsImage
       updated: array to replace image data with - np.ndarray
+      in_place: (optional) write into image's buffer when the pixel types match, rather than allocating a new image - bool
 
     Returns:
       updated_image - ants.ANTsImage
@@ -26,7 +27,16 @@ def update_image_array(image, updated):
     import ants
 
     assert isinstance(image, ants.ANTsImage)
-    assert image.numpy().shape == updated.shape
+    # shape is spatial only, numpy() appends the component axis of vector images such as warps
+    assert (
+        image.shape + ((image.components,) if image.has_components else ())
+        == updated.shape
+    )
+
+    if in_place and image.components == 1 and np.dtype(image.dtype) == updated.dtype:
+        # view is backed by the ITK buffer, so this is a copy into existing memory
+        image.view()[...] = updated
+        return image
 
     updated_image = ants.from_numpy(
         updated,
@@ -39,6 +49,53 @@ def update_image_array(image, updated):
     return updated_image
 
 
+def rescale_image(image, in_place=False):
+    """Linearly rescale image intensities to [0, 1], preserve metadata
+    Works in place on a single copy of the image array
+
+    Args:
+      image - ants.ANTsImage
+      in_place: (optional) see update_image_array - bool
+
+    Returns:
+      rescaled_image - ants.ANTsImage
+      intensity_range: original (min, max) intensities - tuple
+    """
+    image_arr = image.numpy().astype(np.float32, copy=False)
+    image_min, image_max = image_arr.min(), image_arr.max()
+
+    np.subtract(image_arr, image_min, out=image_arr)
+    np.divide(image_arr, image_max - image_min, out=image_arr)
+
+    return (
+        update_image_array(image, image_arr, in_place=in_place),
+        (image_min, image_max),
+    )
+
+
+def equalize_image(image, kernel_size, clip_limit, in_place=False):
+    """Contrast-limited adaptive histogram equalization (CLAHE), preserve metadata
+    Image intensities are expected in [0, 1], see rescale_image
+
+    Args:
+      image - ants.ANTsImage
+      kernel_size: CLAHE kernel size, see skimage.exposure.equalize_adapthist - int or None
+      clip_limit: CLAHE clip limit - float
+      in_place: (optional) see update_image_array - bool
+
+    Returns:
+      equalized_image: float32 - ants.ANTsImage
+    """
+    from skimage.exposure import equalize_adapthist
+
+    equalized = equalize_adapthist(
+        image.numpy(), kernel_size=kernel_size, clip_limit=clip_limit
+    )
+
+    # equalize_adapthist returns float64, ANTs registration works in float32 regardless
+    return update_image_array(image, equalized.astype(np.float32), in_place=in_place)
+
+
 def threshold_image(image, threshold):
     """Set intensity values below threshold to 0
 
@@ -80,20 +137,18 @@ def transpose_image(image, transposition):
     """
     import ants
 
+    transposition = np.asarray(transposition, dtype=np.intp)
     assert sorted(transposition) == list(range(len(transposition)))
 
-    def _permute(arr):
-        return [arr[idx] for idx in transposition]
-
-    image_arr = image.numpy()
-
-    image_arr = np.transpose(image_arr, transposition)
+    # np.transpose only reorders strides, ants.from_numpy makes the single copy
+    image_arr = np.transpose(image.numpy(), transposition)
 
+    # ANTs wants tuples for origin and spacing, the direction cosines are permuted by row
     transposed_image = ants.from_numpy(
         image_arr,
-        origin=_permute(image.origin),
-        spacing=_permute(image.spacing),
-        direction=np.stack(_permute(image.direction)),
+        origin=tuple(np.asarray(image.origin)[transposition]),
+        spacing=tuple(np.asarray(image.spacing)[transposition]),
+        direction=np.asarray(image.direction)[transposition],
         has_components=image.has_components,
     )
 
@@ -120,18 +175,21 @@ def dice_coefficient(image_1, image_2, exclude_labels=[0]):
     labels = np.unique(image_1)
     assert all(labels == np.unique(image_2))
 
-    label_coeffs = {}
+    assert all(float(label).is_integer() for label in labels)
 
-    for label in labels:
-        assert float(label).is_integer()
+    # index of each voxel's label in labels, so all labels are counted in one bincount each
+    indices_1 = np.searchsorted(labels, image_1.ravel())
+    indices_2 = np.searchsorted(labels, image_2.ravel())
 
-        if label not in exclude_labels:
-            mask_1 = image_1 == label
-            mask_2 = image_2 == label
+    sizes_1 = np.bincount(indices_1, minlength=len(labels))
+    sizes_2 = np.bincount(indices_2, minlength=len(labels))
+    overlaps = np.bincount(indices_1[indices_1 == indices_2], minlength=len(labels))
 
-            label_coeffs[int(label)] = (
-                2 * np.sum(mask_1 * mask_2) / (np.sum(mask_1) + np.sum(mask_2))
-            )
+    label_coeffs = {
+        int(label): 2 * overlap / (size_1 + size_2)
+        for label, overlap, size_1, size_2 in zip(labels, overlaps, sizes_1, sizes_2)
+        if label not in exclude_labels
+    }
 
     mean_coeff = np.mean(list(label_coeffs.values()))
 
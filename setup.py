@@ -15,11 +15,11 @@ setup(
     install_requires=[
         "numpy",
         "scipy",
+        "hdf5plugin",
         "nibabel",
         "pynrrd",
         "Pillow",
         "antspyx",
-        "scikit-learn",
         "scikit-image",
         "voxelmorph @ git+https://github.com/ClandininLab/voxelmorph.git@ed92ff23455c8b8942a0c38ee8988223b71410c5",
         "snakemake==7.30.2",